@@ -19,21 +19,84 @@ __credits__ = ["Carlos Santiago",
 
 import pydicom
 import os
+import mmap
 import logging
 import pydicom
+from collections import namedtuple
 
-# Set up logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Define the root directory and folders to save metadata.
 root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 pre_folder = os.path.join(root_dir, "dicom-images-breast", "data", "meta", "pre", "")
 post_folder = os.path.join(root_dir, "dicom-images-breast", "data", "meta", "post", "")
 
+# Whether the metadata folders have been created by this process
+meta_folders_ready = False
+
+# Anonymization parameters of a file, resolved once from the anon_params dict
+AnonContext = namedtuple("AnonContext", [
+  "anon_patient_id",
+  "modality",
+  "view",
+  "laterality",
+  "date",
+  "sequence",
+  "series",
+  "instance",
+])
+
+# Patient, institution, physician and procedure fields to blank
+ANONYMIZED_FIELDS = [
+  'PatientBirthDate',
+  'PatientSex',
+  'PatientAge',
+  'StudyDescription',
+  'SeriesDescription',
+  'InstitutionName',
+  'InstitutionAddress',
+  'InstitutionalDepartmentName',
+  'ReferringPhysicianName',
+  'PhysiciansOfRecord',
+  'WindowCenterWidthExplanation',
+  'RequestingPhysician',
+  'RequestedProcedureDescription',
+  'PerformedProcedureStepDescription',
+  'ScheduledProcedureStepDescription',
+  'PerformingPhysicianName',
+  'CodeMeaning',
+]
+
+# Tags of the fields to blank, resolved once instead of per file and field
+ANONYMIZED_FIELD_TAGS = [(field, pydicom.datadict.tag_for_keyword(field)) for field in ANONYMIZED_FIELDS]
+
+# Sequences and the field to blank in each of their items
+ANONYMIZED_SEQUENCE_FIELDS = [
+  ('RequestedProcedureCodeSequence', 'CodeMeaning'),
+  ('RequestAttributesSequence', 'ScheduledProcedureStepDescription'),
+  ('ConceptNameCodeSequence', 'CodeMeaning'),
+  ('ProcedureCodeSequence', 'CodeMeaning'),
+]
+ANONYMIZED_SEQUENCE_FIELD_TAGS = [
+  (sequence, pydicom.datadict.tag_for_keyword(sequence), pydicom.datadict.tag_for_keyword(field))
+  for sequence, field in ANONYMIZED_SEQUENCE_FIELDS
+]
+
+# Private tags to blank
+ANONYMIZED_PRIVATE_TAGS = [
+  (0x07a3, 0x1019),
+  (0x07a3, 0x101c),
+  (0x0040, 0x0007),
+]
+
 def is_dicom_file(file_path):
   """
   Check if a file is a DICOM file.
 
+  Only the "DICM" prefix after the 128-byte preamble is read, with a single
+  positioned read on a raw file descriptor, so non-DICOM files are rejected
+  without parsing; the full parse happens downstream.
+
   Args:
     file_path (str): Path to the file.
 
@@ -41,89 +104,176 @@ def is_dicom_file(file_path):
     bool: True if the file is a DICOM file, False otherwise.
   """
   try:
-    logging.info(f"Checking if {file_path} is a DICOM file...")
-    pydicom.dcmread(file_path, stop_before_pixels=True)
-    logging.info(f"{file_path} is a DICOM file.")
-    return True
-  except Exception:
-    logging.info(f"{file_path} is not a DICOM file.")
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+      magic = os.pread(fd, 4, 128)
+    finally:
+      os.close(fd)
+  except OSError as e:
+    logger.warning("Cannot read %s: %s", file_path, e)
+    return False
+  if magic != b"DICM":
+    logger.debug("%s is not a DICOM file.", file_path)
     return False
+  return True
 
-def save_meta_pre(meta_to_save_path, dicom_file_path, anon_params):
+def ensure_meta_folders():
+  """
+  Create the folders to save metadata, once per process.
+  """
+  global meta_folders_ready
+  if not meta_folders_ready:
+    os.makedirs(pre_folder, exist_ok=True)
+    os.makedirs(post_folder, exist_ok=True)
+    meta_folders_ready = True
+
+def read_dicom_header(input_path, dicom_only=False):
+  """
+  Read the header of a DICOM file, stopping before the pixel data.
+
+  Args:
+    input_path (str): Path to the DICOM file.
+    dicom_only (bool): Check the "DICM" prefix on the same open file first,
+      instead of a separate is_dicom_file call.
+
+  Returns:
+    tuple: The header dataset and the byte offset of the pixel data element
+      in the file, or the full dataset and None for deflated files, whose
+      pixel data cannot be copied byte for byte. (None, None) if dicom_only
+      is set and the file is not a DICOM file.
+  """
+  with open(input_path, "rb") as f:
+    if dicom_only:
+      f.seek(128)
+      if f.read(4) != b"DICM":
+        return None, None
+      f.seek(0)
+    ds = pydicom.dcmread(f, stop_before_pixels=True)
+    pixel_data_offset = f.tell()
+  if ds.file_meta.get("TransferSyntaxUID") == pydicom.uid.DeflatedExplicitVRLittleEndian:
+    return pydicom.dcmread(input_path), None
+  return ds, pixel_data_offset
+
+# Write buffer of the anonymized DICOM files, so the many small header
+# element writes are coalesced into few system calls
+OUTPUT_BUFFER_SIZE = 1 << 18
+
+def save_dicom(ds, input_path, pixel_data_offset, output_path):
+  """
+  Save an anonymized DICOM header and copy the pixel data from the input file.
+
+  The pixel data (and anything after it) is copied as raw bytes instead of
+  being loaded and re-encoded by pydicom, since it is never modified. The
+  input is memory-mapped so the kernel pages it straight into the write.
+
+  Args:
+    ds (pydicom.Dataset): Anonymized header dataset.
+    input_path (str): Path to the input DICOM file.
+    pixel_data_offset (int): Offset of the pixel data in the input file, or
+      None if ds is a full dataset to be saved as is.
+    output_path (str): Path to save the anonymized DICOM file.
+  """
+  if pixel_data_offset is None:
+    with open(output_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as out:
+      ds.save_as(out)
+    return
+  with open(output_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as out:
+    pydicom.dcmwrite(out, ds, write_like_original=True)
+    with open(input_path, "rb") as src, mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      with memoryview(mm)[pixel_data_offset:] as pixel_data:
+        out.write(pixel_data)
+
+# Filename prefix builders by modality
+PREFIX_BUILDERS = {
+  "MG": lambda c: f"{c.anon_patient_id}_{c.modality}_{c.view}_{c.laterality}",
+  "US": lambda c: f"{c.anon_patient_id}_{c.modality}",
+  "MR": lambda c: f"{c.anon_patient_id}_{c.modality}_{c.series}",
+}
+
+def default_prefix_builder(c):
+  """Build the filename prefix for modalities without a specific format."""
+  return f"{c.anon_patient_id}_{c.modality}_{c.view}_{c.date}"
+
+def generate_filename_prefix(anon_ctx):
+  """
+  Generate the anonymized filename prefix according to the modality.
+
+  Args:
+    anon_ctx (AnonContext): Anonymization parameters of the file.
+
+  Returns:
+    str: Filename prefix.
+  """
+  return PREFIX_BUILDERS.get(anon_ctx.modality, default_prefix_builder)(anon_ctx)
+
+def save_meta_pre(meta_to_save_path, dicom_file_path, anon_ctx, dicom_meta=None):
   """
   Save the DICOM file metadata to a text file before anonymization.
 
   Args:
-    meta_to_save_path (str): Path to the folder to save metadata.
+    meta_to_save_path (str): Path to the folder to save metadata, ending
+      with a path separator.
     dicom_file_path (str): Path to the DICOM file.
-    anon_params (dict): Dictionary containing anonymization parameters.
+    anon_ctx (AnonContext): Anonymization parameters of the file.
+    dicom_meta (pydicom.Dataset, optional): Dataset already read from the
+      DICOM file, to avoid parsing it again.
   """
   try:
-    logging.info(f"Saving metadata for {dicom_file_path} to {meta_to_save_path}...")
+    logger.info("Saving metadata for %s to %s...", dicom_file_path, meta_to_save_path)
     # Read DICOM file
-    dicom_meta = pydicom.dcmread(dicom_file_path)
-    logging.info(f"DICOM file metadata: {dicom_meta}")
-
-    # Determine filename suffix based on modality
-    filename_suffix = f"_{anon_params['date']}_{anon_params['instance'].zfill(4)}.dcm.txt"
-    logging.info(f"Filename suffix: {filename_suffix}")
-
-    # Construct filename prefix
-    if anon_params['modality'] == "MG":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['view']}_{anon_params['laterality']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    elif anon_params['modality'] == "US":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    elif anon_params['modality'] == "MR":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['series']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    else:
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['view']}_{anon_params['date']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
+    if dicom_meta is None:
+      dicom_meta = pydicom.dcmread(dicom_file_path)
+
+    # Determine filename suffix and prefix
+    filename_suffix = f"_{anon_ctx.date}_{anon_ctx.instance.zfill(4)}.dcm.txt"
+    filename_prefix = generate_filename_prefix(anon_ctx)
+    logger.info("Filename: %s%s", filename_prefix, filename_suffix)
 
     # Construct metadata file path
-    metadata_file_path = os.path.join(meta_to_save_path, f"{filename_prefix}{filename_suffix}")
-    logging.info(f"Metadata file path: {metadata_file_path}")
+    metadata_file_path = f"{meta_to_save_path}{filename_prefix}{filename_suffix}"
+    logger.info("Metadata file path: %s", metadata_file_path)
 
     # Save DICOM metadata to the metadata file
     with open(metadata_file_path, "w") as f:
-      logging.info(f"Saving metadata for {dicom_file_path} to {metadata_file_path}...")
+      logger.info("Saving metadata for %s to %s...", dicom_file_path, metadata_file_path)
       f.write(str(dicom_meta))
-      logging.info(f"Metadata saved for {dicom_file_path} to {metadata_file_path}")
+      logger.info("Metadata saved for %s to %s", dicom_file_path, metadata_file_path)
 
-    logging.info(f"Metadata saved as {metadata_file_path}")
+    logger.info("Metadata saved as %s", metadata_file_path)
   except Exception as e:
-    logging.error(f"Failed to save metadata for {dicom_file_path}: {e}")
+    logger.error("Failed to save metadata for %s: %s", dicom_file_path, e)
 
-def save_meta_post(meta_to_save_path, dicom_file_path):
+def save_meta_post(meta_to_save_path, dicom_file_path, dicom_meta=None):
   """
   Save the DICOM file metadata to a text file after anonymization.
 
   Args:
-    meta_to_save_path (str): Path to save the metadata.
+    meta_to_save_path (str): Path to save the metadata, ending with a path
+      separator.
     dicom_file_path (str): Path to the DICOM file.
+    dicom_meta (pydicom.Dataset, optional): Dataset that was saved to the
+      DICOM file, to avoid reading it back.
   """
   try:
-    logging.info(f"Saving metadata for {dicom_file_path} to {meta_to_save_path}...")
-    dicom_meta = pydicom.dcmread(dicom_file_path)
-    logging.info(f"DICOM file metadata: {dicom_meta}")
+    logger.info("Saving metadata for %s to %s...", dicom_file_path, meta_to_save_path)
+    if dicom_meta is None:
+      dicom_meta = pydicom.dcmread(dicom_file_path)
     dicom_file = os.path.basename(dicom_file_path)
-    logging.info(f"Filename: {dicom_file}")
-    metadata_file_path = os.path.join(meta_to_save_path, f"{dicom_file}.txt")
-    logging.info(f"Metadata file path: {metadata_file_path}")
+    logger.info("Filename: %s", dicom_file)
+    metadata_file_path = f"{meta_to_save_path}{dicom_file}.txt"
+    logger.info("Metadata file path: %s", metadata_file_path)
 
     # Save DICOM metadata to the metadata file
     with open(metadata_file_path, "w") as f:
-      logging.info(f"Saving metadata for {dicom_file_path} to {metadata_file_path}...")
+      logger.info("Saving metadata for %s to %s...", dicom_file_path, metadata_file_path)
       f.write(str(dicom_meta))
-      logging.info(f"Metadata saved for {dicom_file_path} to {metadata_file_path}")
+      logger.info("Metadata saved for %s to %s", dicom_file_path, metadata_file_path)
 
-    logging.info(f"Metadata saved as {metadata_file_path}")
+    logger.info("Metadata saved as %s", metadata_file_path)
   except Exception as e:
-    logging.error(f"Failed to save metadata for {meta_to_save_path}: {e}")
+    logger.error("Failed to save metadata for %s: %s", meta_to_save_path, e)
 
-def anonymize_dicom_file(input_path, output_path, anon_params):
+def anonymize_dicom_file(input_path, output_path, anon_params, header=None):
   """
   Anonymize a DICOM file and rename it according to the specified format.
 
@@ -131,293 +281,73 @@ def anonymize_dicom_file(input_path, output_path, anon_params):
     input_path (str): Path to the input DICOM file.
     output_path (str): Path to save the anonymized DICOM file.
     anon_params (dict): Dictionary containing anonymization parameters.
+    header (tuple, optional): Header already returned by read_dicom_header
+      for this file, to avoid parsing it again. It is modified in place.
   """
   try:
-    # Save metadata before anonymization
-    logging.info(f"Saving metadata for {input_path} before anonymization...")
-    save_meta_pre(pre_folder, input_path, anon_params)
-    logging.info(f"Metadata saved for {input_path} before anonymization.")
+    anon_ctx = AnonContext(**anon_params)
+    ensure_meta_folders()
 
-    # Read DICOM file
-    logging.info(f"Reading DICOM file {input_path}...")
-    ds = pydicom.dcmread(input_path)
-    logging.info(f"DICOM file read: {ds}")
+    # Read the DICOM header once; the metadata dumps reuse the parsed dataset
+    ds, pixel_data_offset = header if header is not None else read_dicom_header(input_path)
+
+    # Save metadata before anonymization
+    save_meta_pre(pre_folder, input_path, anon_ctx, ds)
 
-    # Anonymize patient-related fields
-    logging.info(f"Anonymizing patient-related fields...")
+    # Names of the fields anonymized in this file, logged once at the end
+    fields = []
 
-    # Anonymize Patient Name
-    if hasattr(ds, 'PatientName'):
-      logging.info(f"Anonymizing Patient Name: {ds.PatientName}")
+    # Anonymize Patient Name and Patient ID
+    if 'PatientName' in ds:
       ds.PatientName = "Anonymous"
-      logging.info(f"PatientName: {ds.PatientName}")
-    else:
-      logging.info("Attribute 'PatientName' not found in DICOM file.")
-
-    # Anonymize Patient ID
-    if hasattr(ds, 'PatientID'):
-      logging.info(f"Anonymizing Patient ID: {ds.PatientID}")
-      ds.PatientID = anon_params['anon_patient_id']
-      logging.info(f"PatientID: {ds.PatientID}")
-    else:
-      logging.info("Attribute 'PatientID' not found in DICOM file.")
-
-    # Anonymize Patient's Birth Date
-    if hasattr(ds, 'PatientBirthDate'):
-      logging.info(f"Anonymizing Patient's Birth Date: {ds.PatientBirthDate}")
-      ds.PatientBirthDate = ""
-      logging.info(f"PatientBirthDate: {ds.PatientBirthDate}")
-    else:
-      logging.info("Attribute 'PatientBirthDate' not found in DICOM file.")
-    
-    # Anonymize Patient's Sex
-    if hasattr(ds, 'PatientSex'):
-      logging.info(f"Anonymizing Patient's Sex: {ds.PatientSex}")
-      ds.PatientSex = ""
-      logging.info(f"PatientSex: {ds.PatientSex}")
-    else:
-      logging.info("Attribute 'PatientSex' not found in DICOM file.")
-    
-    # Anonymize Patient's Age
-    if hasattr(ds, 'PatientAge'):
-      logging.info(f"Anonymizing Patient's Age: {getattr(ds, 'PatientAge', 'N/A')}")
-      ds.PatientAge = ""
-      logging.info(f"PatientAge: {ds.PatientAge}")
-    else:
-      logging.info("Attribute 'PatientAge' not found in DICOM file.")
-
-    # Anonymize Study Description
-    if hasattr(ds, 'StudyDescription'):
-      logging.info(f"Anonymizing Study Description: {ds.StudyDescription}")
-      ds.StudyDescription = ""
-      logging.info(f"StudyDescription: {ds.StudyDescription}")
-    else:
-      logging.info("Attribute 'StudyDescription' not found in DICOM file.")
-
-    # Anonymize Series Description
-    if hasattr(ds, 'SeriesDescription'):
-      logging.info(f"Anonymizing Series Description: {ds.SeriesDescription}")
-      ds.SeriesDescription = ""
-      logging.info(f"SeriesDescription: {ds.SeriesDescription}")
-    else:
-      logging.info("Attribute 'SeriesDescription' not found in DICOM file.")
-
-    # Anonymize institution-related fields
-
-    # Anonymize Institution Name
-    if hasattr(ds, 'InstitutionName'):
-      logging.info(f"Anonymizing Institution Name: {ds.InstitutionName}")
-      ds.InstitutionName = ""
-      logging.info(f"InstitutionName: {ds.InstitutionName}")
-    else:
-      logging.info("Attribute 'InstitutionName' not found in DICOM file.")
-
-    # Anonymize Institution Address
-    if hasattr(ds, 'InstitutionAddress'):
-      logging.info(f"Anonymizing Institution Address: {ds.InstitutionAddress}")
-      ds.InstitutionAddress = ""
-      logging.info(f"InstitutionAddress: {ds.InstitutionAddress}")
-    else:
-      logging.info("Attribute 'InstitutionAddress' not found in DICOM file.")
-
-    # Anonymize Institutional Department Name
-    if hasattr(ds, 'InstitutionalDepartmentName'):
-      logging.info(f"Anonymizing Institutional Department Name: {ds.InstitutionalDepartmentName}")
-      ds.InstitutionalDepartmentName = ""
-      logging.info(f"InstitutionalDepartmentName: {ds.InstitutionalDepartmentName}")
-    else:
-      logging.info("Institutional Department Name attribute not found.")
-
-    # Anonymize referring physician-related fields
-
-    # Anonymize Referring Physician's Name
-    if hasattr(ds, 'ReferringPhysicianName'):
-      logging.info(f"Anonymizing Referring Physician's Name:  {ds.ReferringPhysicianName}")
-      ds.ReferringPhysicianName = ""
-      logging.info(f"ReferringPhysicianName: {ds.ReferringPhysicianName}")
-    else:
-      logging.info("Attribute 'ReferringPhysicianName' not found in DICOM file.")
-
-    # Anonymize Physician of Record if it exists
-    if hasattr(ds, 'PhysiciansOfRecord'):
-      logging.info(f"Anonymizing Physician of Record: {ds.PhysiciansOfRecord}")
-      ds.PhysiciansOfRecord = ""
-      logging.info(f"PhysiciansOfRecord: {ds.PhysiciansOfRecord}")
-    else:
-      logging.info("PhysiciansOfRecord attribute not found.")
-
-    # Anonymize Window Center & Width Explanation
-    if hasattr(ds, 'WindowCenterWidthExplanation'):
-      logging.info(f"Anonymizing Window Center & Width Explanation: {ds.WindowCenterWidthExplanation}")
-      ds.WindowCenterWidthExplanation = ""
-      logging.info(f"WindowCenterWidthExplanation: {ds.WindowCenterWidthExplanation}")
-    else:
-      logging.info("Attribute 'WindowCenterWidthExplanation' not found in DICOM file.")
-
-    # Anonymize other fields
-
-    # Anonymize Requesting Physician if it exists
-    if hasattr(ds, 'RequestingPhysician'):
-      logging.info(f"Anonymizing Requesting Physician: {ds.RequestingPhysician}")
-      ds.RequestingPhysician = ""
-      logging.info(f"RequestingPhysician: {ds.RequestingPhysician}")
-    else:
-      logging.info("RequestingPhysician attribute not found.")
-
-    # Anonymize Requested Procedure Description if it exists
-    if hasattr(ds, 'RequestedProcedureDescription'):
-      logging.info(f"Anonymizing Requested Procedure Description: {ds.RequestedProcedureDescription}")
-      ds.RequestedProcedureDescription = ""
-      logging.info(f"RequestedProcedureDescription: {ds.RequestedProcedureDescription}")
-    else:
-      logging.info("RequestedProcedureDescription attribute not found.")
-
-    # Anonymize Performed Procedure Step Description
-    if hasattr(ds, 'PerformedProcedureStepDescription'):
-      logging.info(f"Anonymizing Performed Procedure Step Description: {ds.PerformedProcedureStepDescription}")
-      ds.PerformedProcedureStepDescription = ""
-      logging.info(f"PerformedProcedureStepDescription: {ds.PerformedProcedureStepDescription}")
-    else:
-      logging.info("Performed Procedure Step Description attribute not found.")
-
-    # Anonymize Scheduled Procedure Step Description
-    if hasattr(ds, 'ScheduledProcedureStepDescription'):
-      logging.info(f"Anonymizing Scheduled Procedure Step Description: {ds.ScheduledProcedureStepDescription}")
-      ds.ScheduledProcedureStepDescription = ""
-      logging.info(f"ScheduledProcedureStepDescription: {ds.ScheduledProcedureStepDescription}")
-    else:
-      logging.info("Attribute 'ScheduledProcedureStepDescription' not found in DICOM file.")
-
-    # Anonymize Private tag data (07a3, 1019) if it exists
-    if hasattr(ds, '(0x07a3, 0x1019)'):
-      logging.info(f"Anonymizing Private tag data (07a3, 1019): {ds[(0x07a3, 0x1019)].value}")
-      ds[(0x07a3, 0x1019)].value = ""
-      logging.info(f"Private tag data (07a3, 1019): {ds[(0x07a3, 0x1019)].value}")
-    else:
-      logging.info("Attribute (0x07a3, 0x1019) not found in DICOM file.")
-
-    # Anonymize Private tag data (07a3, 101c) if it exists
-    if hasattr(ds, '(0x07a3, 0x101c)'):
-      logging.info(f"Anonymizing Private tag data (07a3, 101c): {ds[(0x07a3, 0x101c)].value}")
-      ds[(0x07a3, 0x101c)].value = ""
-      logging.info(f"Private tag data (07a3, 101c): {ds[(0x07a3, 0x101c)].value}")
-    else:
-      logging.info("Attribute (0x07a3, 0x101c) not found in DICOM file.")
-    
-    # Anonymize Private tag data (0040, 0007) if it exists
-    if hasattr(ds, '(0x0040, 0x0007)'):
-      logging.info(f"Anonymizing Private tag data (0040, 0007): {ds[(0x0040, 0x0007)].value}")
-      ds[(0x0040, 0x0007)].value = ""
-      logging.info(f"Private tag data (0040, 0007): {ds[(0x0040, 0x0007)].value}")
-    else:
-      logging.info("Attribute (0x0040, 0x0007) not found in DICOM file.")
-
-    # Iterate over anonymized Requested Procedure Code Sequence
-    if hasattr(ds, 'RequestedProcedureCodeSequence'):
-      logging.info(f"Anonymizing Requested Procedure Code Sequence")
-      for seq_item in ds.RequestedProcedureCodeSequence:
-        logging.info(f"Anonymizing Requested Procedure Code Sequence item: {seq_item}")
-        if 'CodeMeaning' in seq_item:
-          # Anonymize code meaning in Requested Procedure Code Sequence
-          logging.info(f"Anonymizing Requested Procedure Code Sequence item code meaning: {seq_item.CodeMeaning}")
-          seq_item.CodeMeaning = ""
-          logging.info(f"Requested Procedure Code Sequence item code meaning: {seq_item.CodeMeaning}")
-        else:
-          logging.info("No 'CodeMeaning' attribute found in Requested Procedure Code Sequence item.")
-    else:
-      logging.info("Attribute 'RequestedProcedureCodeSequence' not found in DICOM file.")
-
-    # Iterate over Request Attributes Sequence
-    logging.info(f"Anonymizing Request Attributes Sequence")
-    if hasattr(ds, 'RequestAttributesSequence'):
-      for seq_item in ds.RequestAttributesSequence:
-        logging.info(f"Anonymizing Request Attributes Sequence item: {seq_item}")
-        if hasattr(seq_item, 'ScheduledProcedureStepDescription'):
-          # Anonymize Scheduled Procedure Step Description in Request Attributes Sequence
-          logging.info(f"Anonymizing Request Attributes Sequence item Scheduled Procedure Step Description: {seq_item.ScheduledProcedureStepDescription}")
-          seq_item.ScheduledProcedureStepDescription = ""
-          logging.info(f"Request Attributes Sequence item Scheduled Procedure Step Description: {seq_item.ScheduledProcedureStepDescription}")
-        else:
-          logging.info("Attribute 'ScheduledProcedureStepDescription' not found in Request Attributes Sequence item.")
-    else:
-      logging.info("Attribute 'RequestAttributesSequence' not found in DICOM file.")
-
-    # Anonymize Concept Name Code Sequence
-    logging.info(f"Anonymizing Concept Name Code Sequence")
-    if hasattr(ds, 'ConceptNameCodeSequence'):
-      logging.info(f"Anonymizing Concept Name Code Sequence item: {ds.ConceptNameCodeSequence[0]}")
-      ds.ConceptNameCodeSequence[0].CodeMeaning = ""
-      logging.info(f"Concept Name Code Sequence item: {ds.ConceptNameCodeSequence[0].CodeMeaning}")
-    else:
-      logging.info("Attribute 'ConceptNameCodeSequence' not found in DICOM file.")
-
-    # Anonymize Performing Physician Name
-    if hasattr(ds, 'PerformingPhysicianName'):
-      logging.info(f"Anonymizing Performing Physician Name: {ds.PerformingPhysicianName}")
-      ds.PerformingPhysicianName = ""
-      logging.info(f"Performing Physician Name: {ds.PerformingPhysicianName}")
-    else:
-      logging.info("Attribute 'PerformingPhysicianName' not found in DICOM file.")
-
-    # Anonymize Procedure Code Sequence
-    logging.info(f"Anonymizing Procedure Code Sequence")
-    if 'ProcedureCodeSequence' in ds:
-      for seq_item in ds.ProcedureCodeSequence:
-        logging.info(f"Anonymizing Procedure Code Sequence item: {seq_item}")
-        seq_item.CodeMeaning = ""
-        logging.info(f"Procedure Code Sequence item: {seq_item.CodeMeaning}")
-    else:
-      logging.info("Attribute 'ProcedureCodeSequence' not found in DICOM file.")
-
-    # Anonymize Code Meaning if it exists
-    if hasattr(ds, 'CodeMeaning'):
-      logging.info(f"Anonymizing Code Meaning: {ds.CodeMeaning}")
-      ds.CodeMeaning = ""
-      logging.info(f"CodeMeaning: {ds.CodeMeaning}")
-    else:
-      logging.info("CodeMeaning attribute not found.")
+      fields.append('PatientName')
+    if 'PatientID' in ds:
+      ds.PatientID = anon_ctx.anon_patient_id
+      fields.append('PatientID')
+
+    # Anonymize patient, institution, physician and procedure fields
+    for field, tag in ANONYMIZED_FIELD_TAGS:
+      if tag in ds:
+        ds[tag].value = ""
+        fields.append(field)
+
+    # Anonymize private tag data
+    for tag in ANONYMIZED_PRIVATE_TAGS:
+      if tag in ds:
+        elem = ds[tag]
+        elem.value = b"" if isinstance(elem.value, bytes) else ""
+        fields.append(str(elem.tag))
+
+    # Anonymize fields inside sequence items
+    for sequence, sequence_tag, field_tag in ANONYMIZED_SEQUENCE_FIELD_TAGS:
+      sequence_elem = ds.get(sequence_tag)
+      if sequence_elem is None:
+        continue
+      for seq_item in sequence_elem.value:
+        if field_tag in seq_item:
+          seq_item[field_tag].value = ""
+      fields.append(sequence)
+
+    logger.debug("Anonymized %s fields in %s: %s", len(fields), input_path, ', '.join(fields))
 
     # Save anonymized DICOM file
-    logging.info(f"Saving anonymized DICOM file to {output_path}")
-    post = output_path
-    logging.info(f"Saving anonymized DICOM file to {post}")
-    ds.save_as(output_path)
-    logging.info(f"Anonymized DICOM file saved to {output_path}")
+    save_dicom(ds, input_path, pixel_data_offset, output_path)
 
     # Save metadata after anonymization
-    logging.info(f"Saving metadata after anonymization to {post_folder}")
-    save_meta_post(post_folder, post)
-    logging.info(f"Metadata after anonymization saved to {post_folder}")
-
-    # Determine filename suffix based on modality
-    logging.info(f"Determining filename suffix based on modality")
-    filename_suffix = f"_{anon_params['date']}_{anon_params['instance'].zfill(4)}.dcm"
-    logging.info(f"Filename suffix: {filename_suffix}")
-
-    # Construct filename prefix
-    logging.info(f"Constructing filename prefix")
-    if anon_params['modality'] == "MG":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['view']}_{anon_params['laterality']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    elif anon_params['modality'] == "US":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    elif anon_params['modality'] == "MR":
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['series']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
-    else:
-      filename_prefix = f"{anon_params['anon_patient_id']}_{anon_params['modality']}_{anon_params['view']}_{anon_params['date']}"
-      logging.info(f"Filename prefix: {filename_prefix}")
+    save_meta_post(post_folder, output_path, ds)
+
+    # Determine filename suffix and prefix
+    filename_suffix = f"_{anon_ctx.date}_{anon_ctx.instance.zfill(4)}.dcm"
+    filename_prefix = generate_filename_prefix(anon_ctx)
 
     # Rename anonymized file according to the specified format
-    logging.info(f"Renaming anonymized file to {filename_prefix}{filename_suffix}")
     os.rename(output_path, os.path.join(os.path.dirname(output_path), f"{filename_prefix}{filename_suffix}"))
-    logging.info(f"Anonymized file saved as {filename_prefix}{filename_suffix}")
+    logger.info("Anonymized file saved as %s%s", filename_prefix, filename_suffix)
   
   # Handle exceptions
   except pydicom.errors.InvalidDicomError:
-    logging.warning(f"Ignoring DICOM file with invalid value: {input_path}")
+    logger.warning("Ignoring DICOM file with invalid value: %s", input_path)
   except Exception as e:
-    logging.error(f"Anonymization failed for {input_path}: {e}")
+    logger.error("Anonymization failed for %s: %s", input_path, e)
 
 # End of file
\ No newline at end of file
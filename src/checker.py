@@ -21,6 +21,7 @@ import csv
 import logging
 import warnings
 import pydicom
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from urllib3.exceptions import NotOpenSSLWarning
 
 # Set up logging
@@ -35,71 +36,151 @@ root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 anonymized_dir = os.path.join(root_dir, "dataset-multimodal-breast", "data", "dicom")
 non_anonymized_dir = os.path.join(root_dir, "dicom-images-breast", "known", "raw")
 output_csv_file = os.path.join(root_dir, "dicom-images-breast", "data", "checking", "mapping.csv")
+index_cache_file = os.path.join(root_dir, "dicom-images-breast", "data", "checking", "non_anonymized_index.csv")
 
-# Modality to be used
-modality = 'US'.lower()
+# Modalities to be used, in upper case as DICOM stores them
+SUPPORTED_MODALITIES = frozenset({'US'})
 
 def is_modality(dicom_file):
-  """Check if DICOM file is of the specified modality."""
-  dicom_modality = dicom_file.get("Modality", "").lower()
-  logging.info(f"Modality: {dicom_modality}")
-  return dicom_modality == modality
+  """Check if DICOM file is of a supported modality."""
+  dicom_modality = dicom_file.get("Modality", "")
+  # Only normalize the case of values not already stored in upper case
+  return dicom_modality in SUPPORTED_MODALITIES or dicom_modality.upper() in SUPPORTED_MODALITIES
 
-def is_dicom_file(filepath):
-  """Check if a file is a DICOM file by attempting to read it."""
+def read_dicom_header(filepath):
+  """Read only the InstanceNumber of a DICOM file, or return None if it is not a DICOM file."""
   try:
-    pydicom.dcmread(filepath)
-    return True
+    return pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=['InstanceNumber'])
   except Exception as e:
-    logging.warning(f"Not a DICOM file: {filepath} - {e}")
-    return False
-
-def compare_dicom_files(anonymized_path, non_anonymized_path, output_csv):
-  """Compare DICOM files and save matching paths to CSV."""
-  matching_paths = []
-  anonymized_files = get_all_files(anonymized_path)
-  non_anonymized_files = get_all_files(non_anonymized_path)
-
-  for anonymized_filepath in anonymized_files:
-    logging.info(f"Comparing: {anonymized_filepath}")
-    if not is_dicom_file(anonymized_filepath):
-      logging.warning(f"Not a DICOM file: {anonymized_filepath}")
-      continue
-    anonymized_dicom = pydicom.dcmread(anonymized_filepath)
-
-    if not hasattr(anonymized_dicom, 'InstanceNumber'):
-      logging.warning(f"InstanceNumber not found in DICOM file: {anonymized_filepath}")
-      continue
-
-    for non_anonymized_filepath in non_anonymized_files:
-      logging.info(f"Comparing: {non_anonymized_filepath}")
-      if not is_dicom_file(non_anonymized_filepath):
-        logging.warning(f"Not a DICOM file: {non_anonymized_filepath}")
-        continue
-
-      non_anonymized_dicom = pydicom.dcmread(non_anonymized_filepath)
-      if not hasattr(non_anonymized_dicom, 'InstanceNumber'):
-        continue
-
-      if (anonymized_dicom.InstanceNumber == non_anonymized_dicom.InstanceNumber):
-        matching_paths.append((anonymized_filepath, non_anonymized_filepath))
-        break
-
-  with open(output_csv, mode='w', newline='') as file:
+    logging.warning("Not a DICOM file: %s - %s", filepath, e)
+    return None
+
+def read_instance_number(filepath):
+  """Read the InstanceNumber of a DICOM file, or None if it is not a DICOM file or has none."""
+  dicom_data = read_dicom_header(filepath)
+  if dicom_data is None:
+    return None
+  instance_number = dicom_data.get("InstanceNumber", None)
+  return int(instance_number) if instance_number is not None else None
+
+def load_index_cache(cache_file):
+  """Load the cached instance numbers, keyed by path, with the size and mtime they were read at."""
+  cache = {}
+  if cache_file and os.path.exists(cache_file):
+    with open(cache_file, newline='') as file:
+      reader = csv.reader(file)
+      next(reader, None)
+      for path, size, mtime_ns, instance_number in reader:
+        cache[path] = (int(size), int(mtime_ns), int(instance_number) if instance_number else None)
+  return cache
+
+def index_non_anonymized_files(non_anonymized_path, cache_file=None, executor=None):
+  """Walk and index the non-anonymized files by InstanceNumber in one pass, reusing the cache of previous runs for unchanged files."""
+  cache = load_index_cache(cache_file)
+  entries = []
+  stale = []
+  # Bind the per-file calls to locals, this loop runs once per non-anonymized file
+  stat_file, cache_get, add_entry, add_stale = os.stat, cache.get, entries.append, stale.append
+  for filepath in get_all_files(non_anonymized_path):
+    stat = stat_file(filepath)
+    cached = cache_get(filepath)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+      instance_number = cached[2]
+    else:
+      instance_number = None
+      add_stale(len(entries))
+    add_entry((filepath, stat.st_size, stat.st_mtime_ns, instance_number))
+
+  # Read the new and changed files, in parallel when an executor is given
+  stale_files = [entries[i][0] for i in stale]
+  if executor is not None:
+    instance_numbers = executor.map(read_instance_number, stale_files, chunksize=64)
+  else:
+    instance_numbers = map(read_instance_number, stale_files)
+  for i, instance_number in zip(stale, instance_numbers):
+    entries[i] = entries[i][:3] + (instance_number,)
+  logging.info("Indexed %s non-anonymized files, %s read and %s cached", len(entries), len(stale), len(entries) - len(stale))
+
+  if cache_file:
+    with open(cache_file, mode='w', newline='') as file:
+      writer = csv.writer(file)
+      writer.writerow(['Path', 'Size', 'Modified', 'Instance Number'])
+      writer.writerows((filepath, size, mtime_ns, '' if instance_number is None else instance_number)
+                       for filepath, size, mtime_ns, instance_number in entries)
+
+  # Map each instance number to its first non-anonymized file in walk order
+  non_anonymized_index = {}
+  for filepath, _, _, instance_number in entries:
+    if instance_number is not None:
+      non_anonymized_index.setdefault(instance_number, filepath)
+  return non_anonymized_index
+
+# Non-anonymized index of the workers, set once by init_worker
+worker_index = None
+
+def init_worker(non_anonymized_index):
+  """Hand the non-anonymized index to the workers once, instead of with every file."""
+  global worker_index
+  worker_index = non_anonymized_index
+
+def match_anonymized_file(anonymized_filepath):
+  """Find the non-anonymized file matching an anonymized file, returning the pair of paths or None."""
+  logging.info("Comparing: %s", anonymized_filepath)
+  anonymized_dicom = read_dicom_header(anonymized_filepath)
+  if anonymized_dicom is None:
+    return None
+
+  if not hasattr(anonymized_dicom, 'InstanceNumber'):
+    logging.warning("InstanceNumber not found in DICOM file: %s", anonymized_filepath)
+    return None
+
+  non_anonymized_filepath = worker_index.get(anonymized_dicom.InstanceNumber)
+  if non_anonymized_filepath is None:
+    return None
+  return (anonymized_filepath, non_anonymized_filepath)
+
+def compare_dicom_files(anonymized_path, non_anonymized_path, output_csv, index_cache=None, max_workers=None,
+                        use_processes=False):
+  """Compare DICOM files in parallel and save matching paths to CSV."""
+  anonymized_files = list(get_all_files(anonymized_path))
+
+  # Header reads mostly wait on the disk, so threads are enough unless parsing is the bottleneck
+  cpu_count = os.cpu_count() or 1
+  if use_processes:
+    executor_class, workers = ProcessPoolExecutor, max_workers or cpu_count
+  else:
+    executor_class, workers = ThreadPoolExecutor, max_workers or min(32, cpu_count * 4)
+
+  # Read the non-anonymized headers that are not cached yet in parallel
+  with executor_class(max_workers=workers) as executor:
+    non_anonymized_index = index_non_anonymized_files(non_anonymized_path, index_cache, executor)
+
+  # Match the anonymized files in about four chunks per worker, keeping their order
+  chunksize = max(1, len(anonymized_files) // (4 * workers))
+  with executor_class(max_workers=workers, initializer=init_worker, initargs=(non_anonymized_index,)) as executor:
+    matching_paths = [match for match in executor.map(match_anonymized_file, anonymized_files, chunksize=chunksize) if match]
+
+  with open(output_csv, mode='w', newline='', buffering=1 << 20) as file:
     writer = csv.writer(file)
     writer.writerow(['Anonymized Path', 'Non-Anonymized Path'])
     writer.writerows(matching_paths)
 
 def get_all_files(directory):
-  """Recursively get all files from directory and subdirectories."""
-  file_list = []
-  for root, dirs, files in os.walk(directory):
-    for file in files:
-      file_list.append(os.path.join(root, file))
-  return file_list
+  """Recursively yield all files from directory and subdirectories, in the same order as os.walk."""
+  stack = [directory]
+  while stack:
+    subdirectories = []
+    with os.scandir(stack.pop()) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          subdirectories.append(entry.path)
+        elif entry.is_file():
+          yield entry.path
+    # Push in reverse so the first subdirectory is walked next
+    stack.extend(reversed(subdirectories))
 
 if __name__ == '__main__':
-  compare_dicom_files(anonymized_dir, non_anonymized_dir, output_csv_file)
+  compare_dicom_files(anonymized_dir, non_anonymized_dir, output_csv_file, index_cache_file)
   logging.info("Comparison complete!")
 
 # End of file
\ No newline at end of file
@@ -17,9 +17,9 @@ import os
 import csv
 import logging
 import pydicom
-import shutil
 import warnings
 from urllib3.exceptions import NotOpenSSLWarning
+from fileops import rename_or_move
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -38,14 +38,14 @@ checked_dir = os.path.join(root_dir, "dataset-multimodal-breast", "data", "check
 mapping_csv = os.path.join(root_dir, "dataset-multimodal-breast", "data", "inconsistencies", mapping_fn)
 
 # Debugging output for paths
-logging.info(f"Mapping CSV: {mapping_csv}")
-logging.info(f"Non-anonymized directory: {non_anonymized_dir}")
-logging.info(f"Checking directory: {checking_dir}")
-logging.info(f"Checked directory: {checked_dir}")
+logging.info("Mapping CSV: %s", mapping_csv)
+logging.info("Non-anonymized directory: %s", non_anonymized_dir)
+logging.info("Checking directory: %s", checking_dir)
+logging.info("Checked directory: %s", checked_dir)
 
 def load_mapping(csv_file):
   """Load mapping of anonymized_patient_id to real_patient_id from CSV."""
-  logging.info(f"Loading mapping from {csv_file}")
+  logging.info("Loading mapping from %s", csv_file)
   mapping = {}
   with open(csv_file, mode='r') as file:
     reader = csv.reader(file)
@@ -55,37 +55,37 @@ def load_mapping(csv_file):
       mapping[anonymized_id] = real_id
   return mapping
 
-def is_dicom_file(filepath):
-  """Check if a file is a DICOM file by attempting to read it."""
+def read_dicom_metadata(filepath, tags):
+  """Read specified metadata tags in the same pass that checks the file is DICOM, or return None if it is not."""
   try:
-    pydicom.dcmread(filepath)
-    return True
-  except Exception:
-    return False
-
-def get_metadata(dicom_file, tags):
-  """Extract specified metadata tags from DICOM file."""
-  try:
-    dicom_data = pydicom.dcmread(dicom_file)
-    return {tag: dicom_data.get(tag, "Unknown") for tag in tags}
+    dicom_data = pydicom.dcmread(filepath, stop_before_pixels=True, specific_tags=tags)
   except Exception as e:
-    logging.warning(f"Failed to read DICOM file {dicom_file}: {e}")
-    return {tag: "Unknown" for tag in tags}
+    logging.debug("Failed to read DICOM file %s: %s", filepath, e)
+    return None
+  return {tag: dicom_data.get(tag, "Unknown") for tag in tags}
 
-def find_dicom_files(search_path):
-  """Find all DICOM files in the search directory."""
+def find_dicom_files(search_path, tags):
+  """Find all DICOM files in the search directory, with their specified metadata tags."""
   dicom_files = []
   for root, _, files in os.walk(search_path):
     for file in files:
       filepath = os.path.join(root, file)
-      if is_dicom_file(filepath):
-        dicom_files.append(filepath)
+      metadata = read_dicom_metadata(filepath, tags)
+      if metadata is not None:
+        dicom_files.append((filepath, metadata))
   return dicom_files
 
 def process_dicom(process_path, mapping):
   """Process DICOM files in process_path, map to real_patient_id, and extract metadata."""
   dicom_tags = ["PatientID", "InstanceNumber", "ViewPosition", "ImageLaterality"]
-  
+  moved_count = 0
+
+  # Non-anonymized files and their metadata, read once when first needed
+  non_anonymized_dicom_files = None
+
+  # Create the checked directory once instead of before every move
+  os.makedirs(checked_dir, exist_ok=True)
+
   for root, _, files in os.walk(process_path):
     for file in files:
       if "_MG_" in file:
@@ -94,20 +94,28 @@ def process_dicom(process_path, mapping):
         dicom_file_path = os.path.join(root, file)
         
         if real_patient_id:
-          non_anonymized_dicom_files = find_dicom_files(non_anonymized_dir)
-          for non_anonymized_file in non_anonymized_dicom_files:
-            instance_number_1 = get_metadata(dicom_file_path, ["InstanceNumber"])["InstanceNumber"]
-            instance_number_2 = get_metadata(non_anonymized_file, ["InstanceNumber"])["InstanceNumber"]
-            
-            if instance_number_1 == instance_number_2:
-              view_position = get_metadata(non_anonymized_file, ["ViewPosition"])["ViewPosition"]
-              image_laterality = get_metadata(non_anonymized_file, ["ImageLaterality"])["ImageLaterality"]
+          if non_anonymized_dicom_files is None:
+            non_anonymized_dicom_files = find_dicom_files(non_anonymized_dir, ["InstanceNumber", "ViewPosition", "ImageLaterality"])
+          anonymized_metadata = read_dicom_metadata(dicom_file_path, ["InstanceNumber"])
+          if anonymized_metadata is None:
+            logging.warning("Failed to read DICOM file %s", dicom_file_path)
+            continue
+          instance_number_1 = anonymized_metadata["InstanceNumber"]
+          for non_anonymized_file, metadata in non_anonymized_dicom_files:
+            if instance_number_1 == metadata["InstanceNumber"]:
+              view_position = metadata["ViewPosition"]
+              image_laterality = metadata["ImageLaterality"]
               
               if view_position == "Unknown" or image_laterality == "Unknown":
                 continue
               
               new_file_name = rename_file(file, view_position, image_laterality)
-              move_file(dicom_file_path, os.path.join(checked_dir, new_file_name))
+              if move_file(dicom_file_path, os.path.join(checked_dir, new_file_name)):
+                moved_count += 1
+              # The file is gone once moved, later matches could not move it again
+              break
+
+  logging.info("Moved %s files to %s", moved_count, checked_dir)
 
 def rename_file(file_name, view_position, image_laterality):
   """Rename the file based on the view position and image laterality."""
@@ -117,10 +125,11 @@ def rename_file(file_name, view_position, image_laterality):
   return '_'.join(parts)
 
 def move_file(src_path, dest_path):
-  """Move the file from src_path to dest_path."""
-  if os.path.exists(src_path):
-    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-    shutil.move(src_path, dest_path)
+  """Move the file from src_path to dest_path, returning whether it was moved."""
+  if not os.path.exists(src_path):
+    return False
+  rename_or_move(src_path, dest_path)
+  return True
 
 if __name__ == '__main__':
   logging.info("Starting processing...")
@@ -18,6 +18,7 @@ __credits__ = ["Carlos Santiago",
 
 import os
 import hashlib
+import functools
 
 # Define the root folder path
 root_folder = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -25,10 +26,13 @@ secret_folder = os.path.join(root_folder, "secrets", "phrases")
 secret_file_path = os.path.join(secret_folder, "data_pipeline_secret_phrase.txt")
 
 # Define the function to read the secret phrase from an external file
+@functools.lru_cache(maxsize=1)
 def read_secret_phrase(rsp_secret_file_path):
   """
   Reads the secret phrase from an external file located in the root folder.
 
+  The phrase is cached, so the file is read once per process.
+
   Returns:
     str: Secret phrase read from the file.
   """
@@ -38,30 +42,68 @@ def read_secret_phrase(rsp_secret_file_path):
     rsp_secret_phrase = file.read().strip()
   return rsp_secret_phrase
 
+# Define the function to read the secret phrase as bytes
+@functools.lru_cache(maxsize=1)
+def read_secret_bytes(rsb_secret_file_path):
+  """
+  Reads the secret phrase and encodes it once, ready to be hashed.
+
+  Returns:
+    bytes: Encoded secret phrase.
+  """
+  return read_secret_phrase(rsb_secret_file_path).encode()
+
+# Define the function to hash the secret phrase once
+@functools.lru_cache(maxsize=1)
+def read_secret_hash(rsh_secret_file_path):
+  """
+  Feeds the secret phrase to SHA-256 once; callers copy the resulting state.
+
+  Returns:
+    hashlib.sha256: Hash object holding the secret phrase, never updated in place.
+  """
+  return hashlib.sha256(read_secret_bytes(rsh_secret_file_path))
+
 # Define the function to encrypt the patient ID
+@functools.lru_cache(maxsize=100_000)
 def encrypt_patient_id(patient_id):
   """
   Encrypts the patient ID using SHA-256 hash function with a secret phrase.
 
+  Results are memoized, so repeated IDs are not hashed again. The hash must
+  stay SHA-256: switching to a faster one (e.g. BLAKE2 or BLAKE3) would give
+  every patient a new anonymized ID and break the existing mapping files.
+
   Args:
     patient_id (str): Original patient ID.
 
   Returns:
     str: Encrypted patient ID with the same length as the original.
   """
-  # Read the secret phrase from the file
-  epi_secret_phrase = read_secret_phrase(secret_file_path)
-
-  
-  # Combine the patient ID and secret phrase
-  combined_str = f"{epi_secret_phrase}{patient_id}"
-  
-  # Use SHA-256 hash function for encryption
-  encrypted_id = hashlib.sha256(combined_str.encode()).hexdigest()
+  # Use SHA-256 hash function on the secret phrase followed by the patient ID
+  sha = read_secret_hash(secret_file_path).copy()
+  sha.update(patient_id.encode())
+  encrypted_id = sha.hexdigest()
   
   # Truncate the encrypted ID to match the length of the original patient ID
   encrypted_id = encrypted_id[:len(patient_id)]
   
   return encrypted_id
 
+# Define the function to encrypt a batch of patient IDs
+def encrypt_patient_ids(patient_ids):
+  """
+  Encrypts a batch of unique patient IDs.
+
+  Each ID goes through encrypt_patient_id, so there is a single hashing
+  implementation and every run maps a patient to the same anonymized ID.
+
+  Args:
+    patient_ids (iterable): Original patient IDs.
+
+  Returns:
+    dict: Mapping of each original patient ID to its encrypted ID.
+  """
+  return {patient_id: encrypt_patient_id(patient_id) for patient_id in patient_ids}
+
 # End of file
\ No newline at end of file
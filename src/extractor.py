@@ -16,51 +16,88 @@ __credits__ = ["Carlos Santiago",
                "Jacinto C. Nascimento",
                "Diogo Araújo"]
 
-import pydicom
 import logging
+from collections import namedtuple
+from anonymizer import read_dicom_header
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
-def extract_dicom_info(dicom_file):
+# Tags read from each DICOM file, with the placeholder used when a tag is missing
+EXTRACTED_TAGS = {
+  "PatientID": (0x00100020, "NOPATIENTID"),
+  "Modality": (0x00080060, "NOMODALITY"),
+  "ImageLaterality": (0x00200062, "NOIMAGELATERALITY"),
+  "ViewPosition": (0x00185101, "NOVIEWPOSITION"),
+  "StudyDate": (0x00080020, "NOSTUDYDATE"),
+  "ScanningSequence": (0x00180020, "NOSCANNINGSEQUENCE"),
+  "SeriesDescription": (0x0008103E, "NOSERIESDESCRIPTION"),
+  "InstanceNumber": (0x00200013, "NOINSTANCENUMBER")
+}
+
+# Information extracted from a DICOM file, one field per extracted tag
+DicomInfo = namedtuple("DicomInfo", list(EXTRACTED_TAGS))
+
+# Code string tags canonicalized to upper case once, at extraction
+UPPERCASE_TAGS = frozenset({"Modality", "ImageLaterality", "ViewPosition"})
+
+def canonical(value):
+  """Upper-case a single text value, leaving other values untouched."""
+  return value.upper() if isinstance(value, str) else value
+
+def dicom_info_from_dataset(ds):
+  """
+  Extract the relevant information from a DICOM dataset.
+
+  Args:
+    ds (pydicom.Dataset): Dataset holding at least the extracted tags.
+
+  Returns:
+    DicomInfo: Value of each extracted tag, or its placeholder when missing,
+      with the code strings upper-cased.
   """
-  Extract relevant information from a DICOM file.
+  # Read the modality once, image laterality is not used for MR
+  modality_tag, modality_placeholder = EXTRACTED_TAGS["Modality"]
+  elem = ds.get(modality_tag)
+  modality = canonical(elem.value) if elem is not None else modality_placeholder
+  # Look up each tag directly by its integer, falling back to a placeholder
+  values = []
+  for keyword, (tag, placeholder) in EXTRACTED_TAGS.items():
+    if keyword == "Modality":
+      values.append(modality)
+    elif keyword == "ImageLaterality" and modality == "MR":
+      values.append(placeholder)
+    else:
+      elem = ds.get(tag)
+      value = elem.value if elem is not None else placeholder
+      values.append(canonical(value) if keyword in UPPERCASE_TAGS else value)
+  return DicomInfo(*values)
+
+def extract_dicom_header(dicom_file):
+  """
+  Read the header of a DICOM file once, for both the extraction and the anonymization.
+
+  The "DICM" prefix is checked on the same open file, so candidate files
+  need no separate is_dicom_file pass.
 
   Args:
-    dicom_file (str): Path to the DICOM file.
+    dicom_file (str): Path to the candidate file.
 
   Returns:
-    dict: Dictionary containing extracted information (Modality, Side, View, StudyDate, Sequence).
+    tuple: Extracted DicomInfo and the header returned by read_dicom_header,
+      to be handed to anonymize_dicom_file, or (None, None) if the file is
+      not a DICOM file or cannot be read.
   """
   try:
-    # Extract DICOM information
-    logging.info(f"Extracting DICOM info from {dicom_file}")
-    ds = pydicom.dcmread(dicom_file)
-    logging.info(f"DICOM info extracted: {ds}")
-    # Extract relevant information
-    logging.info("Extracting relevant information")
-    modality = ds.Modality if hasattr(ds, "Modality") else "NOMODALITY"
-    logging.info(f"Modality: {modality}")
-    # Extract patient ID if available, otherwise use a placeholder
-    logging.info("Extracting patient ID")
-    patientid = ds.PatientID if hasattr(ds, "PatientID") else "NOPATIENTID"
-    logging.info(f"Patient ID: {patientid}")
-    # Extract other relevant information
-    logging.info("Extracting other relevant information")
-    info = {
-      "PatientID": patientid,
-      "Modality": modality,
-      "ImageLaterality": ds.ImageLaterality if modality != "MR" and hasattr(ds, "ImageLaterality") else "NOIMAGELATERALITY",
-      "ViewPosition": ds.ViewPosition if hasattr(ds, "ViewPosition") else "NOVIEWPOSITION",
-      "StudyDate": ds.StudyDate if hasattr(ds, "StudyDate") else "NOSTUDYDATE",
-      "ScanningSequence": ds.ScanningSequence if hasattr(ds, "ScanningSequence") else "NOSCANNINGSEQUENCE",
-      "SeriesDescription": ds.SeriesDescription if hasattr(ds, "SeriesDescription") else "NOSERIESDESCRIPTION",
-      "InstanceNumber": ds.InstanceNumber if hasattr(ds, "InstanceNumber") else "NOINSTANCENUMBER"
-    }
-    logging.info(f"Extracted information: {info}")
-    return info
+    logger.debug("Extracting DICOM info from %s", dicom_file)
+    header = read_dicom_header(dicom_file, dicom_only=True)
+    if header[0] is None:
+      return None, None
+    info = dicom_info_from_dataset(header[0])
+    logger.debug("Extracted information: %s", info)
+    return info, header
   except Exception as e:
     # Log an error if the extraction fails
-    logging.error(f"Failed to extract DICOM info from {dicom_file}: {e}")
-    return None
+    logger.error("Failed to extract DICOM info from %s: %s", dicom_file, e)
+    return None, None
 
 # End of file
\ No newline at end of file
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+fileops.py: Module for file operations shared by the checking scripts.
+"""
+
+__author__ = "Francisco Maria Calisto"
+__maintainer__ = "Francisco Maria Calisto"
+__email__ = "francisco.calisto@tecnico.ulisboa.pt"
+__license__ = "ACADEMIC & COMMERCIAL"
+__version__ = "0.1.0"
+__status__ = "Development"
+__copyright__ = "Copyright 2024, Instituto Superior Técnico (IST)"
+__credits__ = ["Carlos Santiago",
+               "Catarina Barata",
+               "Jacinto C. Nascimento",
+               "Diogo Araújo"]
+
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+def rename_or_move(src_path, dest_path):
+  """
+  Move a file, renaming it in place unless the destination is on another filesystem.
+
+  The rename is tried for every file rather than decided once per run, since
+  any subdirectory may be a mount point on another device.
+
+  Args:
+    src_path (str): Path to the file to move.
+    dest_path (str): Path to move the file to.
+  """
+  try:
+    os.replace(src_path, dest_path)
+  except OSError:
+    # Copy and remove the file, e.g. across filesystems (EXDEV)
+    shutil.move(src_path, dest_path)
+  logger.debug("Moved file %s to %s", src_path, dest_path)
+
+# End of file
@@ -65,7 +65,7 @@ def is_dicom_file(filepath):
   logging.info(f"Checking if file {filepath} is a DICOM file")
   try:
     logging.info(f"Reading DICOM file {filepath}")
-    pydicom.dcmread(filepath)
+    pydicom.dcmread(filepath, stop_before_pixels=True)
     logging.info(f"File {filepath} is a DICOM file")
     return True
   except Exception:
@@ -77,7 +77,7 @@ def get_laterality(dicom_file):
   logging.info(f"Getting laterality from DICOM file {dicom_file}")
   try:
     logging.info(f"Reading DICOM file {dicom_file}")
-    dicom_data = pydicom.dcmread(dicom_file)
+    dicom_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=["ImageLaterality"])
     logging.info(f"Reading DICOM file {dicom_file} metadata")
     return dicom_data.get("ImageLaterality", "Unknown")
   except Exception as e:
@@ -89,7 +89,7 @@ def get_instance_number(dicom_file):
   logging.info(f"Getting instance number from DICOM file {dicom_file}")
   try:
     logging.info(f"Reading DICOM file {dicom_file}")
-    dicom_data = pydicom.dcmread(dicom_file)
+    dicom_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=["InstanceNumber"])
     logging.info(f"Reading DICOM file {dicom_file} metadata")
     return dicom_data.get("InstanceNumber", None)
   except Exception as e:
@@ -100,8 +100,8 @@ def check_patient_id(dicom_file, anonymized_id):
   """Check if the Patient ID inside the DICOM file matches the anonymized ID."""
   logging.info(f"Checking Patient ID in DICOM file {dicom_file}")
   try:
-    logging   logging.info(f"Reading DICOM file {dicom_file}")
-    dicom_data = pydicom.dcmread(dicom_file)
+    logging.info(f"Reading DICOM file {dicom_file}")
+    dicom_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=["PatientID"])
     logging.info(f"Reading DICOM file {dicom_file} metadata")
     dicom_patient_id = dicom_data.get("PatientID", "Unknown")
     logging.info(f"Patient ID in DICOM file {dicom_file}: {dicom_patient_id}")
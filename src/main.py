@@ -16,9 +16,12 @@ __credits__ = ["Carlos Santiago",
                "Jacinto C. Nascimento",
                "Diogo Araújo"]
 
+import argparse
 import logging
+import multiprocessing
 import os
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from processor import process_directory
 
 # Define the source and output folders
@@ -32,46 +35,74 @@ logs_fs = f"log_{logs_timestamp}.log"
 logs_folder = os.path.join(root_dir, "dicom-images-breast", "data", "logs", "toprocess")
 logs_file = os.path.join(logs_folder, logs_fs)
 
-# Create logs folder if it doesn't exist
-if not os.path.exists(logs_folder):
-  os.makedirs(logs_folder)
+# Define the mapping file path
+mapping_file = os.path.join(root_dir, "dicom-images-breast", "data", "mapping", "mapping.csv")
 
-# Set up logging to write to the file and console
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler = logging.FileHandler(logs_file)
-file_handler.setFormatter(formatter)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(formatter)
+def setup_logging():
+  """
+  Set up logging to write to the log file and console.
 
-# Add both handlers to the root logger
-logging.root.addHandler(file_handler)
-logging.root.addHandler(console_handler)
-logging.root.setLevel(logging.INFO)
+  Records are put on a queue and written by a background listener thread,
+  so formatting and file I/O stay off the processing path. The queue is a
+  multiprocessing one, handed to the anonymization workers so they log
+  through it too. Kept out of module level so that worker processes
+  importing this module do not open log files of their own.
 
-# Define the mapping file path
-logging.info("Loading mapping file...")
+  Returns:
+    tuple: Started QueueListener, to be stopped once processing ends, and
+      the queue it reads from.
+  """
+  # Create logs folder if it doesn't exist
+  if not os.path.exists(logs_folder):
+    os.makedirs(logs_folder)
 
-# Load mapping file
-mapping_file = os.path.join(root_dir, "dicom-images-breast", "data", "mapping", "mapping.csv")
-logging.info(f"Mapping file loaded: {mapping_file}")
+  formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+  file_handler = logging.FileHandler(logs_file)
+  file_handler.setFormatter(formatter)
+  console_handler = logging.StreamHandler()
+  console_handler.setFormatter(formatter)
+
+  # Route the root logger through the queue to both handlers
+  log_queue = multiprocessing.Queue()
+  listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+  logging.root.addHandler(QueueHandler(log_queue))
+  logging.root.setLevel(logging.INFO)
+  listener.start()
+  return listener, log_queue
 
 # Main function
 def main():
   """
   Main function for running the data processing pipeline.
   """
+  parser = argparse.ArgumentParser(description="Run the data processing pipeline.")
+  parser.add_argument("--verbose", action="store_true", help="Log every DICOM file and its anonymized fields.")
+  args = parser.parse_args()
+  listener, log_queue = setup_logging()
+
+  # Per-file logging is only shown if requested, in this process and the anonymization workers
+  log_levels = {"anonymizer": logging.WARNING}
+  if args.verbose:
+    log_levels = {"anonymizer": logging.DEBUG, "extractor": logging.DEBUG, "processor": logging.DEBUG}
+  for name, level in log_levels.items():
+    logging.getLogger(name).setLevel(level)
+
   logging.info("Starting data processing pipeline...")
-  logging.info(f"Source folder: {source_folder}")
-  logging.info(f"Output folder: {output_folder}")
-  logging.info(f"Mapping file: {mapping_file}")
+  logging.info("Source folder: %s", source_folder)
+  logging.info("Output folder: %s", output_folder)
+  logging.info("Mapping file: %s", mapping_file)
 
   # Create output folder if it doesn't exist
   if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
   # Process DICOM files
-  process_directory(source_folder, output_folder, mapping_file)
-  logging.info("Data processing pipeline completed.")
+  try:
+    process_directory(source_folder, output_folder, mapping_file, log_queue=log_queue, log_levels=log_levels)
+    logging.info("Data processing pipeline completed.")
+  finally:
+    # Write out the queued log records
+    listener.stop()
 
 if __name__ == "__main__":
   main()
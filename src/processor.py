@@ -19,167 +19,374 @@ __credits__ = ["Carlos Santiago",
 import os
 import logging
 import csv
-import pydicom
-from extractor import extract_dicom_info
-from anonymizer import is_dicom_file, anonymize_dicom_file
-from encryption import encrypt_patient_id
+import shelve
+import multiprocessing
+from logging.handlers import QueueHandler
+from contextlib import nullcontext
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from extractor import extract_dicom_header
+from anonymizer import anonymize_dicom_file
+from encryption import encrypt_patient_ids
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
-def process_directory(source_folder, output_folder, mapping_file):
+# Number of DICOM files read and anonymized together; only headers are kept
+# in memory, so large batches are cheap and amortize the per-batch work
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 1024))
+
+# Directories and filenames to ignore
+IGNORED_DIRECTORIES = frozenset()
+IGNORED_FILES = frozenset({'DICOMDIR', 'LOCKFILE', 'VERSION', '.DS_Store'})
+
+# Output folders already created by this process
+ensured_folders = set()
+
+# Characters that make the csv module quote a value
+CSV_SPECIAL_CHARACTERS = frozenset(',"\r\n')
+
+# Number of DICOM headers read concurrently, i.e. the I/O queue depth
+IO_WORKERS = int(os.getenv('IO_WORKERS', 32))
+
+# Start method of the anonymization processes. They are started while the
+# header reading and logging threads run, and forking a process that has
+# other threads can deadlock it on a lock one of them held, so the workers
+# come from a clean forkserver process, or are spawned where it is missing
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def iter_files(folder, ignored_directories=frozenset(), ignored_files=frozenset()):
+  """
+  Recursively yield the paths of the files under a folder.
+
+  Uses os.scandir so the file type comes from the cached directory entry
+  instead of an extra stat() per file, and an explicit stack of folders
+  instead of nested generators. Files are yielded before descending into
+  subdirectories, in the same order as os.walk.
+
+  Args:
+      folder (str): Path to the folder to walk.
+      ignored_directories (frozenset): Names of directories to skip.
+      ignored_files (frozenset): Names of files to skip.
+
+  Yields:
+      str: Path to each file found.
+  """
+  stack = [folder]
+  while stack:
+    subfolders = []
+    with os.scandir(stack.pop()) as entries:
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          # Prune ignored directories by name, so their subtrees are never listed
+          if entry.name not in ignored_directories:
+            subfolders.append(entry.path)
+        elif entry.is_file() and entry.name not in ignored_files:
+          yield entry.path
+    # Push in reverse so the first subfolder is walked next
+    stack.extend(reversed(subfolders))
+
+# Filename prefix builders per modality, called with the anonymized patient ID,
+# modality, view, breast laterality and series description
+FILENAME_PREFIX_BUILDERS = {
+  "MG": lambda a, m, v, l, s: f"{a}_{m}_{v}_{l}",
+  "US": lambda a, m, v, l, s: f"{a}_{m}_{v}_{l}" if l else f"{a}_{m}_{v}",
+}
+
+def mr_prefix_builder(a, m, v, l, s):
+  """Build the filename prefix for MR modalities."""
+  return f"{a}_{m}_{s}"
+
+def default_prefix_builder(a, m, v, l, s):
+  """Build the filename prefix for modalities without a specific format."""
+  return f"{a}_{m}"
+
+def construct_filename_prefix(anon_patient_id, modality, view, breast_laterality, series):
+  """
+  Construct the filename prefix of an anonymized DICOM file according to its modality.
+
+  Args:
+      anon_patient_id (str): Anonymized patient ID.
+      modality (str): Modality of the DICOM file.
+      view (str): View position.
+      breast_laterality (str): Breast side abbreviation, empty if unknown.
+      series (str): Series description.
+
+  Returns:
+      str: Filename prefix.
+  """
+  builder = FILENAME_PREFIX_BUILDERS.get(modality)
+  if builder is None:
+    builder = mr_prefix_builder if modality[:2] == "MR" else default_prefix_builder
+  return builder(anon_patient_id, modality, view, breast_laterality, series)
+
+def build_output_path(output_prefix, anon_patient_id, modality, view, breast_laterality, series, date, instance):
+  """
+  Build the output path of an anonymized DICOM file.
+
+  Args:
+      output_prefix (str): Output folder, ending with a path separator.
+      anon_patient_id (str): Anonymized patient ID.
+      modality (str): Modality of the DICOM file.
+      view (str): View position.
+      breast_laterality (str): Breast side abbreviation, empty if unknown.
+      series (str): Series description.
+      date (str): Study date without dashes.
+      instance (str): Instance number and file counter.
+
+  Returns:
+      str: Path to the anonymized DICOM file.
+  """
+  prefix = construct_filename_prefix(anon_patient_id, modality, view, breast_laterality, series)
+  return f"{output_prefix}{prefix}_{date}_{instance}.dcm"
+
+def ensure_folders(folders):
+  """
+  Create folders, each once per process.
+
+  Args:
+      folders (iterable): Paths to the folders to create.
+  """
+  for folder in folders:
+    if folder not in ensured_folders:
+      os.makedirs(folder, exist_ok=True)
+      ensured_folders.add(folder)
+      logger.info("Ensured output folder: %s", folder)
+
+def iter_batches(iterable, batch_size):
+  """
+  Split an iterable into lists of at most batch_size items.
+
+  Args:
+      iterable (iterable): Items to split.
+      batch_size (int): Maximum number of items per batch.
+
+  Yields:
+      list: Next batch of items.
+  """
+  iterator = iter(iterable)
+  while True:
+    batch = list(islice(iterator, batch_size))
+    if not batch:
+      return
+    yield batch
+
+def write_mapping_rows(f, rows):
+  """
+  Write rows to the mapping file in one call.
+
+  Rows are formatted directly as the csv module would write them, unless a
+  value needs quoting, in which case the csv module writes them instead.
+
+  Args:
+      f (file): Mapping file opened for writing.
+      rows (list): Rows of date, original and anonymized patient IDs.
+  """
+  if all(CSV_SPECIAL_CHARACTERS.isdisjoint(value) for row in rows for value in row):
+    f.write("".join([f"{date},{patient_id},{anon_patient_id}\r\n" for date, patient_id, anon_patient_id in rows]))
+  else:
+    csv.writer(f).writerows(rows)
+
+def load_mapping(mapping_file):
+  """
+  Read the patient ID mapping written by previous runs, one row at a time.
+
+  Args:
+      mapping_file (str): Path to the mapping file of original and anonymized IDs.
+
+  Yields:
+      tuple: Original ID and its (anonymized ID, date), nothing if there is no mapping file.
+  """
+  try:
+    with open(mapping_file, newline='') as f:
+      for row in csv.reader(f):
+        # Skip header rows and malformed lines
+        if len(row) != 3 or row[1] == "real_patient_id":
+          continue
+        date, patient_id, anon_patient_id = row
+        yield patient_id, (anon_patient_id, date)
+  except FileNotFoundError:
+    return
+
+def anonymize_task(task):
+  """
+  Anonymize one DICOM file in a worker process.
+
+  Args:
+      task (tuple): Input path, output path, anonymization parameters and
+        the header already read from the input file.
+
+  Returns:
+      str: Path to the input DICOM file.
+  """
+  input_path, output_path, anon_params, header = task
+  anonymize_dicom_file(input_path, output_path, anon_params, header)
+  return input_path
+
+def init_worker_logging(log_queue, log_levels):
+  """
+  Route the logging of an anonymization process to the parent's log queue.
+
+  Spawned processes start without handlers, and forked ones would keep a
+  copy of the parent's, so the root handlers are replaced in both cases.
+
+  Args:
+      log_queue (multiprocessing.Queue): Queue read by the parent's listener.
+      log_levels (dict): Level of each logger name, as set in the parent.
+  """
+  logging.root.handlers[:] = [QueueHandler(log_queue)]
+  logging.root.setLevel(logging.INFO)
+  for name, level in log_levels.items():
+    logging.getLogger(name).setLevel(level)
+
+def process_directory(source_folder, output_folder, mapping_file, max_workers=None, batch_size=BATCH_SIZE,
+                      id_cache_file=None, io_workers=IO_WORKERS, log_queue=None, log_levels=None):
   """
   Process a directory containing DICOM files to anonymize them and prepare the dataset.
 
+  Files are streamed from the directory walk in batches, so memory use does
+  not grow with the number of files. DICOM headers are read in a thread pool,
+  while the anonymization itself, which is CPU bound, runs in a process pool.
+
   Args:
       source_folder (str): Path to the source directory containing DICOM files.
       output_folder (str): Path to the output directory to save anonymized DICOM files.
       mapping_file (str): Path to the file to write the mapping of original and anonymized IDs.
+      max_workers (int): Number of anonymization processes, defaults to the CPU count.
+      batch_size (int): Number of DICOM files processed together.
+      id_cache_file (str): Optional path of an on-disk store for the anonymized IDs,
+        for datasets with too many patients to keep them in memory.
+      io_workers (int): Number of threads reading DICOM headers concurrently.
+      log_queue (multiprocessing.Queue): Optional queue the anonymization
+        processes log to, whatever the start method.
+      log_levels (dict): Logger levels applied in the anonymization processes.
   """
-  # Initialize variables to track the anonymized IDs and their associated dates
-  anonymized_ids = {}  # Dictionary to store original-to-anonymized ID mapping with dates
-
-  # List of directories or filenames to ignore
-  ignored_directories = []
-  ignored_files = ['DICOMDIR', 'LOCKFILE', 'VERSION', '.DS_Store']
-
   # Initialize instance counter
   instance_counter = 0
 
-  # Flag to indicate if the first row has been written
-  first_row_written = False
-
-  # Iterate through DICOM files in the source folder
-  for root, _, files in os.walk(source_folder):
-    # Skip ignored directories
-    if any(dir_name in root for dir_name in ignored_directories):
-      continue
-
-    for file in files:
-      # Skip ignored files
-      if file in ignored_files:
-        continue
-
-      input_path = os.path.join(root, file)
-      # Check if the file is a DICOM file
-      if is_dicom_file(input_path):
-        try:
-          # Extract DICOM information
-          logging.info(f"Processing DICOM file: {input_path}")
-          dicom_info = extract_dicom_info(input_path)
-          logging.info(f"Extracted DICOM information: {dicom_info}")
-          if dicom_info:
-            # Extract relevant information
-            patient_id = dicom_info.get("PatientID", "NOPATIENTID")
-            logging.info(f"Extracted patient ID: {patient_id}")
-            # Extract study date
-            date = dicom_info.get("StudyDate", "NOSTUDYDATE").replace("-", "")
-            logging.info(f"Extracted study date: {date}")
-
-            # Check if the patient ID has already been anonymized
-            if patient_id not in anonymized_ids:
-              # Generate a new anonymized ID
-              logging.info(f"Generating new anonymized ID for patient ID: {patient_id}")
-              anon_patient_id = encrypt_patient_id(patient_id)
-              logging.info(f"Generated new anonymized ID: {anon_patient_id}")
-              # Add anonymized ID to the dictionary with its associated date
-              logging.info(f"Adding anonymized ID to dictionary: {patient_id} -> {anon_patient_id}")
-              anonymized_ids[patient_id] = (anon_patient_id, date)
-              logging.info(f"Anonymized IDs: {anonymized_ids}")
-
-              # Write mapping to file
-              with open(mapping_file, "a", newline='') as f:
-                logging.info(f"Writing mapping to file: {mapping_file}")
-                writer = csv.writer(f)
-                logging.info(f"Successfully created writer: {writer}")
-                if not first_row_written:
-                  logging.info(f"Writing header row to file: {mapping_file}")
-                  writer.writerow(["real_patient_id_date", "real_patient_id", "anonymized_patient_id"])
-                  logging.info(f"Successfully wrote header row to file: {mapping_file}")
-                  first_row_written = True
-                writer.writerow([f"{date}", patient_id, anon_patient_id])
-                logging.info(f"Successfully wrote mapping to file: {date}, {patient_id}, {anon_patient_id}")
-
-            # Anonymize DICOM file
-            logging.info(f"Anonymizing DICOM file: {input_path}")
-
-            # Extract modality, laterality, view, sequence, and instance
-            logging.info(f"Extracted DICOM information: {dicom_info}")
-            modality = dicom_info.get("Modality", "NOMODALITY")
-            logging.info(f"Extracted modality: {modality}")
-            laterality = dicom_info.get("ImageLaterality")
-            logging.info(f"Extracted laterality: {laterality}")
-            view = dicom_info.get("ViewPosition", "NOVIEWPOSITION")
-            logging.info(f"Extracted view: {view}")
-            sequence = dicom_info.get("ScanningSequence", "NOSCANNINGSEQUENCE")
-            logging.info(f"Extracted sequence: {sequence}")
-            series = dicom_info.get("SeriesDescription", "NOSERIESDESCRIPTION")
-            logging.info(f"Extracted series: {series}")
-            instance_number = dicom_info.get("InstanceNumber", "NOINSTANCENUMBER")
-            logging.info(f"Extracted instance number: {instance_number}")
-            instance_counter += 1
-
-            # Convert instance_counter to 8-digit string
-            logging.info(f"Converting instance counter to 8-digit string: {instance_counter}")
-            instance = f"{instance_number}_{instance_counter:08}"
-            logging.info(f"Converted instance counter: {instance}")
-
-            # Determine breast side abbreviation (L for left, R for right)
-            logging.info(f"Determining breast side abbreviation: {laterality}")
-            breast_laterality = laterality.upper() if laterality else ""
-            logging.info(f"Determined breast side abbreviation: {breast_laterality}")
-            logging.info(f"Constructing filename prefix: {anon_patient_id}, {modality}, {view}, {breast_laterality}")
-
-            # Construct filename prefix
-            if modality == "MG":
-              logging.info(f"Constructing MG filename prefix: {anon_patient_id}, {modality}, {view}, {breast_laterality}")
-              filename_prefix = f"{anon_patient_id}_{modality}_{view}_{breast_laterality}"
-              logging.info(f"Constructed MG filename prefix: {filename_prefix}")
-            elif modality == "US":
-              logging.info(f"Constructing US filename prefix: {anon_patient_id}, {modality}, {view}")
-              filename_prefix = f"{anon_patient_id}_{modality}_{view}_{breast_laterality}" if laterality else f"{anon_patient_id}_{modality}_{view}"
-              logging.info(f"Constructed US filename prefix: {filename_prefix}")
-            elif modality.startswith("MR"):
-              logging.info(f"Constructing MR filename prefix: {anon_patient_id}, {modality}, {series}")
-              filename_prefix = f"{anon_patient_id}_{modality}_{series}"
-              logging.info(f"Constructed MR filename prefix: {filename_prefix}")
-            else:
-              logging.info(f"Constructing default filename prefix: {anon_patient_id}, {modality}, {view}, {date}")
-              filename_prefix = f"{anon_patient_id}_{modality}"
-              logging.info(f"Constructed default filename prefix: {filename_prefix}")
-
-            # Construct output path
-            logging.info(f"Constructing output path: {output_folder}, {filename_prefix}, {date}, {instance}")
-            output_path = os.path.join(output_folder, f"{filename_prefix}_{date}_{instance}.dcm")
-            logging.info(f"Constructed output path: {output_path}")
-
-            # Anonymize DICOM file
-            logging.info(f"Anonymizing DICOM file: {input_path} -> {output_path}")
-
-            # Construct anonymization parameters dictionary
-            anon_params = {
-              'anon_patient_id': anon_patient_id,
-              'modality': modality,
-              'view': view,
-              'laterality': laterality,
-              'date': date,
-              'sequence': sequence,
-              'series': series,
-              'instance': instance
-            }
-            logging.info(f"Constructed anonymization parameters dictionary: {anon_params}")
-
-            # Create output folder if it doesn't exist
-            if not os.path.exists(output_folder):
-              os.makedirs(output_folder)
-              logging.info(f"Created output folder: {output_folder}")
-
-            # Anonymize DICOM file
-            logging.info(f"Anonymizing DICOM file: {input_path} -> {output_path}")
-            anonymize_dicom_file(input_path, output_path, anon_params)
-            logging.info(f"Anonymized DICOM file: {input_path} -> {output_path}")
-
-        except pydicom.errors.InvalidDicomError:
-          logging.warning(f"Ignoring DICOM file with invalid value: {input_path}")
-          continue
+  # Output folder with a trailing separator, to build the output paths
+  output_prefix = os.path.join(output_folder, "")
+
+  def process_batch(batch, extracted, anonymized_ids, f, cpu_pool):
+    """
+    Anonymize a batch of DICOM files.
+
+    Args:
+        batch (list): Paths to the candidate files of the batch.
+        extracted (iterable): DICOM information and header extracted from each file of the batch.
+        anonymized_ids (dict): Original-to-anonymized ID mapping with dates.
+        f (file): Mapping file opened for writing.
+        cpu_pool (ProcessPoolExecutor): Pool anonymizing the DICOM files.
+    """
+    nonlocal instance_counter
+
+    # Wait for the DICOM information of the whole batch
+    extracted = list(extracted)
+
+    # Hash the patient IDs first seen in this batch in one go
+    new_ids = {dicom_info.PatientID for dicom_info, _ in extracted
+               if dicom_info and dicom_info.PatientID not in anonymized_ids}
+    logger.info("Generating anonymized IDs for %s new patients", len(new_ids))
+    id_map = encrypt_patient_ids(new_ids)
+
+    # Keep the files whose information could be extracted, as parallel columns
+    rows = [(input_path, dicom_info, header) for input_path, (dicom_info, header) in zip(batch, extracted) if dicom_info]
+    if not rows:
+      return
+    input_paths, dicom_infos, headers = map(list, zip(*rows))
+    dates = [dicom_info.StudyDate.replace("-", "") for dicom_info in dicom_infos]
+
+    # Look up the anonymized IDs in walk order, queueing a mapping row for each new patient
+    anon_patient_ids = []
+    mapping_rows = []
+    for dicom_info, date in zip(dicom_infos, dates):
+      patient_id = dicom_info.PatientID
+      known_id = anonymized_ids.get(patient_id)
+      if known_id is not None:
+        anon_patient_id = known_id[0]
+      else:
+        # Add anonymized ID to the dictionary with its associated date
+        anon_patient_id = id_map[patient_id]
+        anonymized_ids[patient_id] = (anon_patient_id, date)
+        mapping_rows.append([date, patient_id, anon_patient_id])
+      anon_patient_ids.append(anon_patient_id)
+
+    # Number the files of the batch after those of the previous batches
+    instances = [f"{dicom_info.InstanceNumber}_{counter:08}"
+                 for counter, dicom_info in enumerate(dicom_infos, instance_counter + 1)]
+    instance_counter += len(dicom_infos)
+
+    # Build the output paths of the whole batch in one pass, using the breast
+    # side abbreviation (L for left, R for right) upper-cased by the extractor
+    output_paths = [build_output_path(output_prefix, anon_patient_id, dicom_info.Modality, dicom_info.ViewPosition,
+                                      dicom_info.ImageLaterality, dicom_info.SeriesDescription, date, instance)
+                    for anon_patient_id, dicom_info, date, instance in zip(anon_patient_ids, dicom_infos, dates, instances)]
+
+    # Construct the anonymization parameters of each file
+    anon_params = [{
+      'anon_patient_id': anon_patient_id,
+      'modality': dicom_info.Modality,
+      'view': dicom_info.ViewPosition,
+      'laterality': dicom_info.ImageLaterality,
+      'date': date,
+      'sequence': dicom_info.ScanningSequence,
+      'series': dicom_info.SeriesDescription,
+      'instance': instance
+    } for anon_patient_id, dicom_info, date, instance in zip(anon_patient_ids, dicom_infos, dates, instances)]
+    tasks = list(zip(input_paths, output_paths, anon_params, headers))
+
+    # Create the output folders of the batch that do not exist yet
+    ensure_folders({os.path.dirname(output_path) for output_path in output_paths})
+
+    # Write the mapping rows of the batch at once
+    write_mapping_rows(f, mapping_rows)
+
+    # Anonymize the DICOM files of the batch in parallel, in about four chunks per worker
+    chunksize = max(1, len(tasks) // (4 * workers))
+    for input_path in cpu_pool.map(anonymize_task, tasks, chunksize=chunksize):
+      logger.debug("Anonymized DICOM file: %s", input_path)
+    logger.info("Processed batch of %s DICOM files", len(tasks))
+
+  # Number of anonymization processes
+  workers = max_workers or os.cpu_count() or 1
+
+  # Stream the files found in the source folder, the header reads skip those that are not DICOM files
+  candidate_files = iter_files(source_folder, IGNORED_DIRECTORIES, IGNORED_FILES)
+
+  # Have the anonymization processes log to the parent's queue when one is given
+  worker_logging = {}
+  if log_queue is not None:
+    worker_logging = {"initializer": init_worker_logging, "initargs": (log_queue, log_levels or {})}
+
+  # Track the anonymized IDs and their associated dates, in memory unless an on-disk store is requested,
+  # and open the mapping file once for the whole run
+  with (shelve.open(id_cache_file, flag="n") if id_cache_file else nullcontext({})) as anonymized_ids, \
+       open(mapping_file, "a", newline='', buffering=1 << 20) as f, \
+       ThreadPoolExecutor(max_workers=io_workers) as io_pool, \
+       ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                           **worker_logging) as cpu_pool:
+    # Resume from the patients already mapped by previous runs
+    # Keep the first mapping of each patient, as it was written to the file
+    for patient_id, anonymized in load_mapping(mapping_file):
+      if patient_id not in anonymized_ids:
+        anonymized_ids[patient_id] = anonymized
+    logger.info("Loaded %s patients from mapping file: %s", len(anonymized_ids), mapping_file)
+
+    # Write the header only when starting a new mapping file
+    logger.info("Writing mapping to file: %s", mapping_file)
+    if f.tell() == 0:
+      csv.writer(f).writerow(["real_patient_id_date", "real_patient_id", "anonymized_patient_id"])
+
+    # Submit the header reads of each batch before anonymizing the previous one,
+    # so reading the next batch overlaps with the CPU bound work
+    previous = None
+    for batch in iter_batches(candidate_files, batch_size):
+      current = (batch, io_pool.map(extract_dicom_header, batch))
+      if previous is not None:
+        process_batch(*previous, anonymized_ids, f, cpu_pool)
+        # Flush the mapping rows of each batch, so an interrupted run keeps them
+        f.flush()
+      previous = current
+    if previous is not None:
+      process_batch(*previous, anonymized_ids, f, cpu_pool)
 
 # End of file
\ No newline at end of file
@@ -16,10 +16,11 @@ __credits__ = ["Carlos Santiago", "Catarina Barata", "Jacinto C. Nascimento", "D
 import os
 import logging
 import pydicom
-import shutil
 import warnings
 import pandas as pd
 from urllib3.exceptions import NotOpenSSLWarning
+from anonymizer import is_dicom_file, read_dicom_header, save_dicom
+from fileops import rename_or_move
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -43,122 +44,120 @@ mapping_csv_path = os.path.join(root_dir, "dataset-multimodal-breast", "data", "
 # mapping_csv_path = os.path.join(root_dir, "dataset-multimodal-breast", "data", "inconsistencies", mapping_fn)
 
 # Load the mapping CSV into a DataFrame, ensuring the header row is skipped
-logging.info(f"Loading mapping CSV from {mapping_csv_path}")
-mapping_df = pd.read_csv(mapping_csv_path, dtype=str)
-logging.info(f"First few rows of the mapping CSV:\n{mapping_df.head()}")
+logging.info("Loading mapping CSV from %s", mapping_csv_path)
+mapping_df = pd.read_csv(mapping_csv_path, usecols=['real_patient_id', 'anonymized_patient_id'], dtype=str)
+logging.info("First few rows of the mapping CSV:\n%s", mapping_df.head())
 
 # Log the shape of the DataFrame to confirm the correct number of rows
-logging.info(f"Shape of the mapping DataFrame: {mapping_df.shape}")
+logging.info("Shape of the mapping DataFrame: %s", mapping_df.shape)
 
 # Load the mapping into a dictionary for quick lookup
-mapping_dict = pd.Series(mapping_df.anonymized_patient_id.values, index=mapping_df.real_patient_id).to_dict()
-logging.info(f"Mapping dictionary created with {len(mapping_dict)} entries")
-
-def is_dicom_file(filepath):
-  """Check if a file is a DICOM file by attempting to read it."""
-  logging.info(f"Checking if {filepath} is a DICOM file...")
-  try:
-    pydicom.dcmread(filepath)
-    logging.info(f"{filepath} is a DICOM file.")
-    return True
-  except Exception:
-    logging.info(f"{filepath} is not a DICOM file.")
-    return False
+mapping_dict = dict(zip(mapping_df['real_patient_id'].to_numpy(), mapping_df['anonymized_patient_id'].to_numpy()))
+logging.info("Mapping dictionary created with %s entries", len(mapping_dict))
 
 def get_instance_number(dicom_file):
   """Extract instance number from DICOM metadata."""
-  logging.info(f"Extracting instance number from DICOM metadata for file: {dicom_file}")
   try:
-    dicom_data = pydicom.dcmread(dicom_file)
+    dicom_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=['InstanceNumber'])
     instance_number = dicom_data.get("InstanceNumber", None)
-    logging.info(f"Instance Number for {dicom_file}: {instance_number}")
+    logging.debug("Instance Number for %s: %s", dicom_file, instance_number)
     return instance_number
   except Exception as e:
-    logging.warning(f"Failed to read DICOM file {dicom_file}: {e}")
+    logging.warning("Failed to read DICOM file %s: %s", dicom_file, e)
     return None
 
-def get_patient_id(dicom_file):
-  """Extract patient ID from DICOM metadata."""
-  logging.info(f"Extracting patient ID from DICOM metadata for file: {dicom_file}")
+def update_dicom_metadata(dicom_file, new_patient_id):
+  """Update the PatientID in the DICOM metadata, copying the pixel data as raw bytes."""
+  # The pixel data is copied from the original file, so write a new file and swap it in
+  temp_file = f"{dicom_file}.tmp"
   try:
-    dicom_data = pydicom.dcmread(dicom_file)
-    patient_id = dicom_data.get("PatientID", "Unknown")
-    logging.info(f"Patient ID for {dicom_file}: {patient_id}")
-    return patient_id
+    dicom_data, pixel_data_offset = read_dicom_header(dicom_file)
+    dicom_data.PatientID = new_patient_id
+    save_dicom(dicom_data, dicom_file, pixel_data_offset, temp_file)
+    os.replace(temp_file, dicom_file)
+    logging.debug("Updated DICOM metadata for %s with new PatientID: %s", dicom_file, new_patient_id)
   except Exception as e:
-    logging.warning(f"Failed to read DICOM file {dicom_file}: {e}")
-    return "Unknown"
+    logging.warning("Failed to update DICOM metadata for %s: %s", dicom_file, e)
+    if os.path.exists(temp_file):
+      os.remove(temp_file)
 
-def update_dicom_metadata(dicom_file, new_patient_id):
-  """Update the PatientID in the DICOM metadata."""
-  logging.info(f"Updating DICOM metadata for file: {dicom_file}")
+def read_dicom_metadata(dicom_file):
+  """Read the instance number and patient ID of a DICOM file in a single header-only pass, or None if it cannot be read."""
   try:
-    dicom_data = pydicom.dcmread(dicom_file)
-    dicom_data.PatientID = new_patient_id
-    dicom_data.save_as(dicom_file)
-    logging.info(f"Updated DICOM metadata for {dicom_file} with new PatientID: {new_patient_id}")
+    dicom_data = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=['InstanceNumber', 'PatientID'])
+    return dicom_data.get("InstanceNumber", None), dicom_data.get("PatientID", "Unknown")
   except Exception as e:
-    logging.warning(f"Failed to update DICOM metadata for {dicom_file}: {e}")
+    logging.warning("Failed to read DICOM file %s: %s", dicom_file, e)
+    return None
 
 def find_dicom_files(search_path):
-  """Find all DICOM files in the search directory."""
-  logging.info(f"Finding DICOM files in {search_path}")
+  """Find all DICOM files in the search directory as (path, instance_number, patient_id) tuples."""
+  logging.info("Finding DICOM files in %s", search_path)
   dicom_files = []
   for root, _, files in os.walk(search_path):
-    logging.info(f"Checking directory {root}")
+    logging.debug("Checking directory %s", root)
     for file in files:
       filepath = os.path.join(root, file)
-      if is_dicom_file(filepath):
-        dicom_files.append(filepath)
-        logging.info(f"Found DICOM file: {filepath}")
+      # Skip files that are not DICOM or cannot be parsed
+      metadata = read_dicom_metadata(filepath) if is_dicom_file(filepath) else None
+      if metadata is not None:
+        instance_number, patient_id = metadata
+        dicom_files.append((filepath, instance_number, patient_id))
+        logging.debug("Found DICOM file: %s (Instance Number: %s, Patient ID: %s)", filepath, instance_number, patient_id)
   return dicom_files
 
 def process_dicom_files(checking_path, non_anonymized_path, checked_path, mapping_dict):
   """Process DICOM files, correct anonymized_patient_id and metadata, and move to checked directory."""
-  logging.info(f"Scanning for DICOM files in {non_anonymized_path}")
+  logging.info("Scanning for DICOM files in %s", non_anonymized_path)
   non_anonymized_files = find_dicom_files(non_anonymized_path)
-  logging.info(f"Found {len(non_anonymized_files)} DICOM files in {non_anonymized_path}")
+  logging.info("Found %s DICOM files in %s", len(non_anonymized_files), non_anonymized_path)
+
+  # Index the non-anonymized files by instance number, keeping their walk order
+  by_instance = {}
+  for non_anonymized_file, non_anonymized_instance_number, real_patient_id in non_anonymized_files:
+    by_instance.setdefault(non_anonymized_instance_number, []).append((non_anonymized_file, real_patient_id))
+
+  # Create the checked directory once
+  os.makedirs(checked_path, exist_ok=True)
+
+  # Count the outcomes instead of logging every file, see the summary at the end
+  stats = {'processed': 0, 'matched': 0, 'corrected': 0, 'unmatched': 0}
 
-  logging.info(f"Scanning for DICOM files in {checking_path}")
+  logging.info("Scanning for DICOM files in %s", checking_path)
   for root, _, files in os.walk(checking_path):
-    logging.info(f"Checking directory {root}")
+    logging.debug("Checking directory %s", root)
     for file in files:
       if "_MG_" in file:
-        logging.info(f"Processing file {file}")
-        anonymized_id = file.split('_')[0]
+        stats['processed'] += 1
+        anonymized_id, _, rest = file.partition('_')
         dicom_file_path = os.path.join(root, file)
         instance_number = get_instance_number(dicom_file_path)
-        logging.info(f"Anonymized ID from filename: {anonymized_id}")
-        logging.info(f"Instance Number from anonymized file: {instance_number}")
-
-        for non_anonymized_file in non_anonymized_files:
-          logging.info(f"Checking non-anonymized file {non_anonymized_file}")
-          non_anonymized_instance_number = get_instance_number(non_anonymized_file)
-          real_patient_id = get_patient_id(non_anonymized_file)
-          logging.info(f"Non-anonymized Instance Number: {non_anonymized_instance_number}, Real Patient ID: {real_patient_id}")
-
-          if instance_number == non_anonymized_instance_number:
-            correct_anonymized_id = mapping_dict.get(real_patient_id, None)
-            
-            if correct_anonymized_id:
-              logging.info(f"Correct anonymized ID for real patient ID {real_patient_id} is {correct_anonymized_id}")
-            else:
-              logging.warning(f"No mapping found for real patient ID {real_patient_id}")
-              correct_anonymized_id = anonymized_id
-
-            if correct_anonymized_id != anonymized_id:
-              logging.info(f"Correcting anonymized_patient_id in {dicom_file_path} to {correct_anonymized_id}")
-              new_file_name = f"{correct_anonymized_id}_{'_'.join(file.split('_')[1:])}"
-              new_file_path = os.path.join(checked_path, new_file_name)
-              logging.info(f"New file name: {new_file_name}")
-              logging.info(f"New file path: {new_file_path}")
-
-              os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
-              shutil.move(dicom_file_path, new_file_path)
-              logging.info(f"Renamed and moved file {dicom_file_path} to {new_file_path}")
-              update_dicom_metadata(new_file_path, correct_anonymized_id)
-              logging.info(f"Updated metadata for {new_file_path} with PatientID: {correct_anonymized_id}")
-            break
+        logging.debug("Processing file %s (Anonymized ID: %s, Instance Number: %s)", file, anonymized_id, instance_number)
+
+        for non_anonymized_file, real_patient_id in by_instance.get(instance_number, ()):
+          stats['matched'] += 1
+          logging.debug("Matched non-anonymized file %s with Real Patient ID: %s", non_anonymized_file, real_patient_id)
+          correct_anonymized_id = mapping_dict.get(real_patient_id, None)
+          
+          if not correct_anonymized_id:
+            logging.warning("No mapping found for real patient ID %s", real_patient_id)
+            correct_anonymized_id = anonymized_id
+
+          if correct_anonymized_id != anonymized_id:
+            new_file_name = f"{correct_anonymized_id}_{rest}"
+            new_file_path = os.path.join(checked_path, new_file_name)
+
+            rename_or_move(dicom_file_path, new_file_path)
+            update_dicom_metadata(new_file_path, correct_anonymized_id)
+            stats['corrected'] += 1
+            logging.info("Corrected %s to %s with PatientID: %s", dicom_file_path, new_file_path, correct_anonymized_id)
+          break
+        else:
+          stats['unmatched'] += 1
+          logging.debug("No non-anonymized file with Instance Number %s for %s", instance_number, file)
+
+  logging.info("Processed %d files: %d matched, %d corrected, %d unmatched",
+               stats['processed'], stats['matched'], stats['corrected'], stats['unmatched'])
 
 if __name__ == '__main__':
   logging.info("Starting DICOM file processing...")